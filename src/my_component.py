@@ -10,13 +10,20 @@ def run(datadir):
     print(parameters)
     in_file = datadir + '/in/tables/source.csv'
     out_file = datadir + '/out/tables/destination.csv'
-    with open(in_file, mode='rt', encoding='utf-8') as in_file, \
-            open(out_file, mode='wt', encoding='utf-8') as out_file:
+    with open(in_file, mode='rt', encoding='utf-8',
+              newline='') as in_file, \
+            open(out_file, mode='wt', encoding='utf-8',
+                 newline='') as out_file:
         lazy_lines = (line.replace('\0', '') for line in in_file)
-        reader = csv.DictReader(lazy_lines, dialect='kbc')
-        writer = csv.DictWriter(out_file, dialect='kbc',
-                                fieldnames=reader.fieldnames)
-        writer.writeheader()
-        for row in reader:
-            writer.writerow({'id': int(row['id']) * 42,
-                             'sound': row['sound'] + 'ping'})
+        reader = csv.reader(lazy_lines, dialect='kbc')
+        writer = csv.writer(out_file, dialect='kbc')
+        header = next(reader)
+        i_id = header.index('id')
+        i_sound = header.index('sound')
+
+        def transform(rows):
+            for row in rows:
+                yield int(row[i_id]) * 42, row[i_sound] + 'ping'
+
+        writer.writerow(('id', 'sound'))
+        writer.writerows(transform(reader))
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+import functools
+import os
+
+from sftp_writer import DEFAULT_WORKERS, connect, storbinary_deflate, \
+    storbinary_sendfile, upload_files
+
+Server = "servername.com"
+Username = "username"
+Password = "secret password"
+filenames = ["/path/to/folder"]
+Directory = "/path/on/server"
+Compress = os.environ.get('SFTP_WRITER_COMPRESS', '0') == '1'
+Workers = int(os.environ.get('SFTP_WRITER_WORKERS', DEFAULT_WORKERS))
+
+print("Uploading " + str(filenames) + " to " + str(Directory), flush=True)
+
+upload_files(functools.partial(connect, Server, Username, Password, Directory),
+             filenames, Workers,
+             storbinary_deflate if Compress else storbinary_sendfile)
+
+print("Done")
@@ -1,86 +1,531 @@
 """
-The script contains example of the paramiko usage for large file uploading.
+FTP upload of large files built on :mod:`ftplib`.
 
-It implements :func:`upload` with limited number of concurrent requests to server, whereas
-paramiko implementation of the :method:`paramiko.SFTPClient.putfo` send read requests without
-limitations, that can cause problems if large file is being downloaded.
+:func:`upload_files` uploads a batch of files over a small pool of sessions,
+splitting very large files into byte ranges (:func:`upload_ranges`). Data is
+sent with ``sendfile`` (:func:`storbinary_sendfile`) or deflated in
+``MODE Z`` (:func:`storbinary_deflate`). Interrupted sequential uploads are
+resumed with ``REST``; an interrupted range upload starts over.
 """
-
-
-
-
-
-#!/usr/bin/env python3
 import ftplib
 import os
+import queue
 import time
 import socket
-from kbc.env_handler import KBCEnvHandler
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+UPLOAD_BLOCKSIZE = 64 * 1024
+# bytes handed to a single sendfile() call, i.e. the progress reporting
+# granularity
+SENDFILE_CHUNK_SIZE = 16 * UPLOAD_BLOCKSIZE
+SOCKET_TIMEOUT = 60
+MAX_RETRY_DELAY = 30
+MAX_RETRIES = 50
+DEFAULT_WORKERS = 4
+# stay below the default sshd/ftpd limit of concurrent unauthenticated
+# connections (MaxStartups 10)
+MAX_WORKERS = 8
+# files at least this large are split into byte ranges uploaded over parallel
+# data connections
+PARALLEL_UPLOAD_THRESHOLD = 256 * 1024 * 1024
+# explicit send buffer of the data connections; by default (0) the kernel
+# autotunes it, which an explicit value (clamped to net.core.wmem_max) disables
+SEND_BUFFER_SIZE = int(os.environ.get('SFTP_WRITER_SNDBUF', 0))
+# milliseconds of unacknowledged data after which the kernel drops the data
+# connection with ETIMEDOUT (Linux only)
+TCP_USER_TIMEOUT = 30000
+# ftplib raises EOFError when the server drops the control connection without
+# a 421 reply; TimeoutError is distinct from socket.timeout before Python 3.10
+RETRYABLE_ERRORS = (ConnectionError, EOFError, TimeoutError,
+                    ftplib.error_temp, socket.gaierror, socket.timeout)
+# errors of make_ftp() while the server is unreachable or restarting, e.g.
+# EHOSTUNREACH, which are retried as well
+RECONNECT_ERRORS = RETRYABLE_ERRORS + (OSError,)
+
+
+class TunedFTP(ftplib.FTP):
+    """
+    :class:`ftplib.FTP` whose data connections are tuned for bulk uploads
+    over high-latency links.
+    """
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = super().ntransfercmd(cmd, rest)
+        try:
+            if SEND_BUFFER_SIZE:
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                SEND_BUFFER_SIZE)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if hasattr(socket, 'TCP_USER_TIMEOUT'):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                                TCP_USER_TIMEOUT)
+        except BaseException:
+            # the server already accepted the command and waits for the data
+            conn.close()
+            drain_reply(self)
+            raise
+        return conn, size
 
 
-class FtpUploadTracker:
+class UploadTracker:
     sizeWritten = 0
-    totalSize = 0.0
-    lastShownPercent = 0
+    totalSize = 0
 
     def __init__(self, totalSize):
-        self.totalSize = totalSize
+        self.totalSize = int(totalSize)
+        self.reportInterval = max(1, self.totalSize // 100)
+        self.nextReport = self.reportInterval
+        self.lock = threading.Lock()
+
+    def handle(self, size):
+        with self.lock:
+            self.sizeWritten += size
+
+            if self.sizeWritten >= self.nextReport:
+                percentComplete = (self.sizeWritten * 100) // self.totalSize
+                reports = self.sizeWritten // self.reportInterval + 1
+                self.nextReport = reports * self.reportInterval
+                print(str(percentComplete) + "% complete remaining: "
+                      + str(self.totalSize - self.sizeWritten))
+
+
+def storbinary_sendfile(ftp, cmd, fp, callback=None, rest=None, count=None):
+    """
+    Zero-copy counterpart of :meth:`ftplib.FTP.storbinary`.
 
-    def handle(self, block):
-        self.sizeWritten += 1024
-        percentComplete = round((self.sizeWritten / self.totalSize) * 100)
+    The data connection is fed by :meth:`socket.socket.sendfile`, which uses
+    ``os.sendfile`` for regular files and falls back to a buffered copy
+    otherwise. ``callback`` receives the number of bytes sent by each call.
+    When ``count`` is given only that many bytes starting at ``rest`` are
+    sent. Unlike ``storbinary`` it does not switch to ``TYPE I`` on every
+    call; sessions from :func:`connect` are already in binary mode.
+    """
+    offset = rest or 0
+    end = None if count is None else offset + count
+    conn = ftp.transfercmd(cmd, rest)
+    try:
+        with conn:
+            while end is None or offset < end:
+                chunk = SENDFILE_CHUNK_SIZE
+                if end is not None:
+                    chunk = min(chunk, end - offset)
+                sent = conn.sendfile(fp, offset=offset, count=chunk)
+                if not sent:
+                    break
+                offset += sent
+                if callback:
+                    callback(sent)
+    except BaseException:
+        drain_reply(ftp)
+        raise
+    return finish_transfer(ftp)
+
+
+def storbinary_deflate(ftp, cmd, fp, callback=None, rest=None):
+    """
+    Variant of :func:`storbinary_sendfile` that deflates the data on the fly
+    in ``MODE Z``.
+
+    Falls back to :func:`storbinary_sendfile` when the server refuses
+    ``MODE Z``. Stream mode is restored once the transfer reply has been read,
+    so that other data connections (e.g. listings) stay uncompressed.
+    """
+    try:
+        ftp.voidcmd('MODE Z')
+    except ftplib.error_perm:
+        return storbinary_sendfile(ftp, cmd, fp, callback, rest)
+    try:
+        if rest:
+            fp.seek(rest)
+        compressor = zlib.compressobj()
+        # one reusable read buffer instead of a new bytes object per block
+        buf = memoryview(bytearray(UPLOAD_BLOCKSIZE))
+        conn = ftp.transfercmd(cmd, rest)
+        try:
+            with conn:
+                while True:
+                    size = fp.readinto(buf)
+                    if not size:
+                        break
+                    conn.sendall(compressor.compress(buf[:size]))
+                    if callback:
+                        callback(size)
+                conn.sendall(compressor.flush())
+        except BaseException:
+            drain_reply(ftp)
+            raise
+        return finish_transfer(ftp)
+    finally:
+        restore_stream_mode(ftp)
 
-        if (self.lastShownPercent != percentComplete):
-            self.lastShownPercent = percentComplete
-            print(str(percentComplete) + "% complete remaining: " + str(self.totalSize - self.sizeWritten), flush=True)
 
+def drain_reply(ftp):
+    """
+    Read the reply to an aborted transfer.
 
+    Otherwise the next command on the session would receive it. The session
+    is closed when the reply cannot be read.
+    """
+    try:
+        ftp.voidresp()
+    except (ftplib.error_reply, ftplib.error_temp, ftplib.error_perm):
+        pass
+    except ftplib.all_errors:
+        ftp.close()
 
-if __name__ == "__main__":
-    Server="servername.com"
-    Username="username"
-    Password="secret password"
-    filename = "/path/to/folder"
-    Directory="/path/on/server"
 
+def finish_transfer(ftp):
+    """
+    Read the reply to a completed transfer, closing the session if the
+    control connection fails while waiting for it.
+    """
+    try:
+        return ftp.voidresp()
+    except (OSError, EOFError):
+        ftp.close()
+        raise
+
+
+def restore_stream_mode(ftp):
+    """
+    Switch the session back to ``MODE S``.
+
+    Errors are ignored: they must not mask the error of the transfer itself,
+    and a session that died is replaced by a new one in stream mode anyway.
+    """
+    if ftp.sock is None:
+        return
+    try:
+        ftp.voidcmd('MODE S')
+    except ftplib.all_errors:
+        pass
+
+
+def connect(server, username, password, directory, port=21):
+    # ftplib applies the timeout to the data connections as well
+    ftp = TunedFTP(timeout=SOCKET_TIMEOUT)
+    try:
+        ftp.set_debuglevel(int(os.environ.get('SFTP_WRITER_DEBUG', '0')))
+        ftp.connect(server, port)
+        print("login", flush=True)
+        ftp.login(username, password)
+        # ftp.set_pasv(False)
+        ftp.cwd(directory)
+        # binary mode for the whole session, SIZE and every STOR rely on it
+        ftp.voidcmd('TYPE I')
+        ftp.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except BaseException:
+        ftp.close()
+        raise
+    return ftp
+
+
+def is_alive(ftp):
+    if ftp.sock is None:
+        return False
+    try:
+        ftp.voidcmd('NOOP')
+        return True
+    except ftplib.all_errors:
+        return False
+
+
+def wait_before_retry(tries, address=None):
+    """
+    Sleep with exponential backoff before retry number ``tries + 1``.
+
+    When the ``(host, port)`` of a dead session is given, the server is
+    probed with plain TCP connects and the wait ends as soon as it accepts
+    connections again.
+    """
+    delay = min(MAX_RETRY_DELAY, 1.5 ** tries)
+    if address is None:
+        time.sleep(delay)
+        return
+    end = time.monotonic() + delay
+    while True:
+        try:
+            with socket.create_connection(address, timeout=1):
+                return
+        except OSError:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(0.5, remaining))
+
+
+def call_with_retries(ftp, make_ftp, operation, max_retries=MAX_RETRIES):
+    """
+    Call ``operation(ftp)`` until it succeeds and return ``(ftp, result)``.
+
+    Transient errors are retried up to ``max_retries`` times, after which the
+    last one is raised. The session is re-created with ``make_ftp()`` only
+    when it no longer answers; a reconnect that fails at the network level
+    counts as one more attempt, so a restarting server is waited for.
+    ``ftp`` may be ``None`` to connect lazily. The returned session is still
+    open; on failure it is closed.
+    """
     tries = 0
-    done = False
+    address = None
+
+    while True:
+        tries += 1
+        if ftp is None:
+            try:
+                ftp = make_ftp()
+            except RECONNECT_ERRORS as e:
+                print(str(type(e)) + ": " + str(e))
+                if tries >= max_retries:
+                    raise
+                print("trying again")
+                # keep probing the server that went away
+                wait_before_retry(tries, address)
+                continue
+        try:
+            return ftp, operation(ftp)
+
+        except RETRYABLE_ERRORS as e:
+            print(str(type(e)) + ": " + str(e))
+            address = None
+            if not is_alive(ftp):
+                print("connection died, reconnecting")
+                address = (ftp.host, ftp.port)
+                ftp.close()
+                ftp = None
+            if tries >= max_retries:
+                if ftp is not None:
+                    ftp.close()
+                raise
+            print("trying again")
+            wait_before_retry(tries, address)
+        except BaseException:
+            ftp.close()
+            raise
+
+
+class SessionPool:
+    """
+    Slots for at most ``size`` FTP sessions created by ``make_ftp()``.
+
+    A slot holds ``None`` until an upload connects it, so sessions are only
+    opened when needed. Only sessions that are still open go back to the
+    pool; a closed one frees its slot for a new connection.
+    """
+
+    def __init__(self, make_ftp, size):
+        self.make_ftp = make_ftp
+        self.slots = queue.Queue()
+        for _ in range(size):
+            self.slots.put(None)
 
-    print("Uploading " + str(filename) + " to " + str(Directory), flush=True)
+    def acquire(self):
+        """
+        Take a slot, blocking until one is free. Returns its session or
+        ``None`` when the caller has to connect.
+        """
+        return self.slots.get()
 
-    while tries < 50 and not done:
+    def release(self, ftp):
+        if ftp is not None and ftp.sock is None:
+            ftp = None
+        self.slots.put(ftp)
+
+    def run(self, operation, max_retries=MAX_RETRIES):
+        """
+        :func:`call_with_retries` on a session of the pool, returning the
+        result of ``operation``.
+        """
+        ftp = self.acquire()
         try:
-            tries += 1
-            with ftplib.FTP(Server) as ftp:
-                ftp.set_debuglevel(2)
-                print("login", flush=True)
-                ftp.login(Username, Password)
-                # ftp.set_pasv(False)
-                ftp.cwd(Directory)
+            ftp, result = call_with_retries(ftp, self.make_ftp, operation,
+                                            max_retries)
+        finally:
+            # call_with_retries() closes the session it fails with, and may
+            # already have replaced the one it was given
+            self.release(ftp)
+        return result
+
+    def close(self):
+        while not self.slots.empty():
+            ftp = self.slots.get_nowait()
+            if ftp is not None:
+                ftp.close()
+
+
+def remote_size(ftp, name):
+    """
+    Size of the remote file ``name``, 0 when it does not exist.
+    """
+    try:
+        return ftp.size(name) or 0
+    except ftplib.error_perm:
+        return 0
+
+
+def delete_if_exists(ftp, name):
+    try:
+        ftp.delete(name)
+    except ftplib.error_perm:
+        pass
+
+
+def file_upload(filename, store=storbinary_sendfile):
+    """
+    Operation for :func:`call_with_retries` that uploads ``filename`` into
+    the working directory of the session, resuming a partial remote copy if
+    there is one.
+    """
+    basename = os.path.basename(filename)
+    stor_cmd = 'STOR ' + basename
+    totalSize = os.path.getsize(filename)
+    print('Total file size : ' + str(round(totalSize / 1024 / 1024, 1))
+          + ' Mb', flush=True)
+
+    def upload(ftp):
+        with open(filename, 'rb', buffering=UPLOAD_BLOCKSIZE) as f:
+            uploadTracker = UploadTracker(totalSize)
+
+            # Get file size if exists
+            rest_pos = remote_size(ftp, basename)
+            if rest_pos:
+                print("Resuming", flush=True)
+                f.seek(rest_pos, 0)
+                print("seek to " + str(rest_pos))
+                uploadTracker.sizeWritten = rest_pos
+                resp = store(ftp, stor_cmd, f, uploadTracker.handle,
+                             rest=rest_pos)
+            else:
+                resp = store(ftp, stor_cmd, f, uploadTracker.handle)
+            print(resp, flush=True)
+
+    return upload
+
+
+def upload_with_retries(ftp, make_ftp, filename, store=storbinary_sendfile,
+                        max_retries=MAX_RETRIES):
+    """
+    Upload ``filename`` into the working directory of ``ftp``, resuming a
+    partial remote copy if there is one.
+
+    Retries and session handling are those of :func:`call_with_retries`.
+    Returns the session that is still open.
+    """
+    ftp, _ = call_with_retries(ftp, make_ftp, file_upload(filename, store),
+                               max_retries)
+    return ftp
+
+
+def upload_ranges(pool, filename, workers=DEFAULT_WORKERS,
+                  max_retries=MAX_RETRIES):
+    """
+    Upload one large file as ``workers`` byte ranges stored in parallel with
+    ``REST``, on sessions taken from ``pool``.
+
+    The ranges go to ``<name>.part``, which is renamed once complete: an
+    interrupted parallel upload leaves holes, so it starts over and must not
+    be mistaken for a partial copy that can be resumed. If such a partial
+    copy from an interrupted sequential upload exists, nothing is uploaded
+    and ``False`` is returned so that the caller resumes it instead.
+
+    The first block is stored without ``REST`` to create (and truncate) the
+    part file. Every range then starts at a non-zero offset, so no later
+    ``STOR`` can truncate data already written by the others. Servers that do
+    not accept ``REST`` beyond the end of the file refuse the ``STOR`` with
+    :class:`ftplib.error_perm`. The same error is raised when the part file
+    does not have the size of ``filename`` (the server ignored the offset)
+    or cannot be renamed; in every case the part file is removed first.
+    """
+    basename = os.path.basename(filename)
+    part = basename + '.part'
+    stor_cmd = 'STOR ' + part
+    totalSize = os.path.getsize(filename)
+    head = min(SENDFILE_CHUNK_SIZE, totalSize)
+    workers = max(1, min(workers, MAX_WORKERS))
+
+    if pool.run(lambda ftp: remote_size(ftp, basename), max_retries):
+        return False
+
+    uploadTracker = UploadTracker(totalSize)
+
+    def upload_range(start, length):
+        def upload(ftp):
+            sent = [0]
+
+            def handle(size):
+                sent[0] += size
+                uploadTracker.handle(size)
+
+            try:
                 with open(filename, 'rb') as f:
-                    totalSize = os.path.getsize(filename)
-                    print('Total file size : ' + str(round(totalSize / 1024 / 1024 ,1)) + ' Mb', flush=True)
-                    uploadTracker = FtpUploadTracker(int(totalSize))
-
-                    # Get file size if exists
-                    files_list = ftp.nlst()
-                    print(files_list, flush=True)
-                    if os.path.basename(filename) in files_list:
-                        print("Resuming", flush=True)
-                        ftp.voidcmd('TYPE I')
-                        rest_pos = ftp.size(os.path.basename(filename))
-                        f.seek(rest_pos, 0)
-                        print("seek to " + str(rest_pos))
-                        uploadTracker.sizeWritten = rest_pos
-                        print(ftp.storbinary('STOR ' + os.path.basename(filename), f, blocksize=1024, callback=uploadTracker.handle, rest=rest_pos), flush=True)
-                    else:
-                        print(ftp.storbinary('STOR ' + os.path.basename(filename), f, 1024, uploadTracker.handle), flush=True)
-                        done = True
-
-        except (BrokenPipeError, ftplib.error_temp, socket.gaierror) as e:
-            print(str(type(e)) + ": " + str(e))
-            print("connection died, trying again")
-            time.sleep(30)
+                    storbinary_sendfile(ftp, stor_cmd, f, handle,
+                                        rest=start or None, count=length)
+            except BaseException:
+                # the whole range is sent again
+                uploadTracker.handle(-sent[0])
+                raise
+
+        pool.run(upload, max_retries)
+
+    def replace(ftp):
+        size = remote_size(ftp, part)
+        if size != totalSize:
+            # the server accepted REST but did not write at that offset
+            raise ftplib.error_perm('550 ' + part + ' has ' + str(size)
+                                    + ' bytes instead of ' + str(totalSize))
+        delete_if_exists(ftp, basename)
+        ftp.rename(part, basename)
+
+    try:
+        upload_range(0, head)
+        if totalSize > head:
+            range_size = -(-(totalSize - head) // workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(upload_range, start,
+                                    min(range_size, totalSize - start))
+                    for start in range(head, totalSize, range_size)]
+                for future in futures:
+                    future.result()
+        pool.run(replace, max_retries)
+    except ftplib.error_perm:
+        pool.run(lambda ftp: delete_if_exists(ftp, part), max_retries)
+        raise
+    return True
+
+
+def upload_files(make_ftp, filenames, workers=DEFAULT_WORKERS,
+                 store=storbinary_sendfile):
+    """
+    Upload ``filenames`` concurrently over a pool of at most ``workers`` FTP
+    sessions created by ``make_ftp()``.
+
+    Large files are split into ranges (:func:`upload_ranges`) that share the
+    same pool, so ``workers`` bounds the number of sessions in any case.
+    """
+    workers = max(1, min(workers, MAX_WORKERS))
+    pool = SessionPool(make_ftp, workers)
 
+    def upload_one(filename):
+        print("Uploading " + str(filename), flush=True)
+        # MODE Z streams cannot be split into ranges
+        if (store is storbinary_sendfile and
+                os.path.getsize(filename) >= PARALLEL_UPLOAD_THRESHOLD):
+            try:
+                if upload_ranges(pool, filename, workers):
+                    return
+            except ftplib.error_perm as e:
+                print("parallel upload refused (" + str(e)
+                      + "), uploading sequentially", flush=True)
+        pool.run(file_upload(filename, store))
 
-    print("Done")
\ No newline at end of file
+    try:
+        with ThreadPoolExecutor(
+                max_workers=max(1, min(workers, len(filenames)))) as executor:
+            futures = [executor.submit(upload_one, filename)
+                       for filename in filenames]
+            for future in futures:
+                future.result()
+    finally:
+        pool.close()
@@ -0,0 +1,499 @@
+import ftplib
+import functools
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+from src.plugin.writer.sftp import sftp_writer
+
+# keeps pyftpdlib from installing its own stderr logging
+logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+
+
+class FtpServerTestCase(unittest.TestCase):
+    handler = FTPHandler
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('user', 'secret', cls.root, perm='elradfmwMT')
+        handler = type('Handler', (cls.handler,), {'authorizer': authorizer})
+        cls.server = FTPServer(('127.0.0.1', 0), handler)
+        cls.port = cls.server.socket.getsockname()[1]
+        cls.stopped = threading.Event()
+        cls.thread = threading.Thread(target=cls.serve)
+        cls.thread.start()
+
+    @classmethod
+    def serve(cls):
+        while not cls.stopped.is_set():
+            cls.server.serve_forever(timeout=0.05, blocking=False,
+                                     handle_exit=False)
+        cls.server.close_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stopped.set()
+        cls.thread.join()
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        self.remote_dir = tempfile.mkdtemp(dir=self.root)
+        self.local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local_dir)
+        # a lost reply fails a test instead of stalling it for a minute
+        patcher = mock.patch.object(sftp_writer, 'SOCKET_TIMEOUT', 5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.make_ftp = functools.partial(
+            sftp_writer.connect, '127.0.0.1', 'user', 'secret',
+            '/' + os.path.basename(self.remote_dir), self.port)
+        patcher = mock.patch.object(sftp_writer, 'wait_before_retry')
+        self.wait_before_retry = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def local_file(self, name, size):
+        path = os.path.join(self.local_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def assertUploaded(self, path):
+        remote = os.path.join(self.remote_dir, os.path.basename(path))
+        with open(path, 'rb') as local, open(remote, 'rb') as uploaded:
+            self.assertEqual(local.read(), uploaded.read())
+
+
+class ConnectTestCase(FtpServerTestCase):
+    def test_sessions_time_out_without_a_default_timeout(self):
+        self.assertIsNone(socket.getdefaulttimeout())
+        ftp = self.make_ftp()
+        self.addCleanup(ftp.close)
+
+        conn = ftp.transfercmd('STOR data.bin')
+        conn.close()
+        ftp.voidresp()
+
+        self.assertEqual(ftp.sock.gettimeout(), 5)
+        self.assertEqual(conn.gettimeout(), 5)
+
+
+class TunedFTPTestCase(FtpServerTestCase):
+    def test_tunes_data_connection(self):
+        ftp = self.make_ftp()
+        self.addCleanup(ftp.close)
+
+        with mock.patch.object(sftp_writer, 'SEND_BUFFER_SIZE', 256 * 1024):
+            conn = ftp.transfercmd('STOR data.bin')
+        with conn:
+            # Linux doubles the value for bookkeeping overhead
+            self.assertGreaterEqual(
+                conn.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                256 * 1024)
+            self.assertTrue(
+                conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        ftp.voidresp()
+
+    def test_failed_tuning_closes_data_connection(self):
+        ftp = self.make_ftp()
+        self.addCleanup(ftp.close)
+        conns = []
+
+        def failing_setsockopt(sock, *args):
+            conns.append(sock)
+            raise OSError(22, 'Invalid argument')
+
+        with mock.patch.object(socket.socket, 'setsockopt',
+                               failing_setsockopt), \
+                self.assertRaises(OSError):
+            ftp.transfercmd('STOR data.bin')
+
+        self.assertEqual(conns[0].fileno(), -1)
+        self.assertEqual(ftp.voidcmd('NOOP')[:3], '200')
+
+
+class UploadWithRetriesTestCase(FtpServerTestCase):
+    def test_resumes_partial_remote_file(self):
+        path = self.local_file('data.bin', 3 * 1024 * 1024 + 17)
+        with open(path, 'rb') as f, \
+                open(os.path.join(self.remote_dir, 'data.bin'), 'wb') as r:
+            r.write(f.read(1000000))
+
+        ftp = sftp_writer.upload_with_retries(None, self.make_ftp, path)
+        ftp.close()
+
+        self.assertUploaded(path)
+
+    def test_recovers_from_timeout_during_transfer(self):
+        path = self.local_file('data.bin', 5 * 1024 * 1024)
+        sendfile = socket.socket.sendfile
+        calls = []
+
+        def flaky_sendfile(sock, *args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise socket.timeout('timed out')
+            return sendfile(sock, *args, **kwargs)
+
+        with mock.patch.object(socket.socket, 'sendfile', flaky_sendfile):
+            ftp = sftp_writer.upload_with_retries(None, self.make_ftp, path)
+        # the reply to the aborted transfer must not leak into later commands
+        self.assertTrue(sftp_writer.is_alive(ftp))
+        ftp.close()
+
+        self.assertUploaded(path)
+        self.assertEqual(self.wait_before_retry.call_count, 1)
+
+    def test_raises_last_error_after_max_retries(self):
+        path = self.local_file('data.bin', 10)
+        make_ftp = mock.Mock(side_effect=socket.gaierror('no such host'))
+
+        with self.assertRaises(socket.gaierror):
+            sftp_writer.upload_with_retries(None, make_ftp, path,
+                                            max_retries=3)
+        self.assertEqual(make_ftp.call_count, 3)
+
+
+class CallWithRetriesTestCase(FtpServerTestCase):
+    def test_reconnects_when_server_drops_the_session(self):
+        ftp = self.make_ftp()
+        # the server closes the control connection without a 421 reply
+        ftp.voidcmd('QUIT')
+        self.assertEqual(ftp.sock.recv(1, socket.MSG_PEEK), b'')
+        errors = []
+
+        def size(ftp):
+            try:
+                return ftp.size('data.bin')
+            except ftplib.all_errors as e:
+                errors.append(type(e))
+                raise
+
+        self.local_file('data.bin', 10)
+        shutil.copy(os.path.join(self.local_dir, 'data.bin'), self.remote_dir)
+        make_ftp = mock.Mock(side_effect=self.make_ftp)
+
+        ftp, result = sftp_writer.call_with_retries(ftp, make_ftp, size)
+        ftp.close()
+
+        self.assertEqual(result, 10)
+        self.assertEqual(errors, [EOFError])
+        self.assertEqual(make_ftp.call_count, 1)
+
+    def test_retries_refused_connection(self):
+        make_ftp = mock.Mock(
+            side_effect=[ConnectionRefusedError(), self.make_ftp()])
+
+        ftp, result = sftp_writer.call_with_retries(None, make_ftp,
+                                                    sftp_writer.is_alive)
+        ftp.close()
+
+        self.assertTrue(result)
+        self.assertEqual(make_ftp.call_count, 2)
+
+    def test_keeps_probing_while_server_restarts(self):
+        ftp = self.make_ftp()
+        address = (ftp.host, ftp.port)
+        ftp.voidcmd('QUIT')
+        self.assertEqual(ftp.sock.recv(1, socket.MSG_PEEK), b'')
+        unreachable = OSError(113, 'No route to host')
+        make_ftp = mock.Mock(side_effect=[
+            ConnectionRefusedError(), unreachable, self.make_ftp()])
+
+        ftp, result = sftp_writer.call_with_retries(
+            ftp, make_ftp, lambda ftp: ftp.voidcmd('NOOP'))
+        ftp.close()
+
+        self.assertEqual(result[:3], '200')
+        self.assertEqual(self.wait_before_retry.call_args_list,
+                         [mock.call(1, address), mock.call(2, address),
+                          mock.call(3, address)])
+
+    def test_raises_reconnect_error_after_max_retries(self):
+        make_ftp = mock.Mock(side_effect=ConnectionRefusedError())
+
+        with self.assertRaises(ConnectionRefusedError):
+            sftp_writer.call_with_retries(None, make_ftp, sftp_writer.is_alive,
+                                          max_retries=3)
+        self.assertEqual(make_ftp.call_count, 3)
+
+
+class UploadTrackerTestCase(unittest.TestCase):
+    @mock.patch('builtins.print')
+    def test_reports_integers_for_float_size(self, print):
+        tracker = sftp_writer.UploadTracker(1000.0)
+
+        tracker.handle(25)
+
+        self.assertEqual(tracker.reportInterval, 10)
+        self.assertIsInstance(tracker.nextReport, int)
+        print.assert_called_once_with('2% complete remaining: 975')
+
+
+class WaitBeforeRetryTestCase(unittest.TestCase):
+    @mock.patch.object(sftp_writer.time, 'sleep')
+    def test_sleeps_full_delay_without_address(self, sleep):
+        sftp_writer.wait_before_retry(3)
+        sftp_writer.wait_before_retry(20)
+
+        self.assertEqual(sleep.call_args_list,
+                         [mock.call(1.5 ** 3),
+                          mock.call(sftp_writer.MAX_RETRY_DELAY)])
+
+    def test_returns_once_server_accepts_connections(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        # refuses connections until it listens
+        timer = threading.Timer(0.5, server.listen)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        start = time.monotonic()
+        sftp_writer.wait_before_retry(20, server.getsockname())
+        elapsed = time.monotonic() - start
+
+        self.assertGreaterEqual(elapsed, 0.4)
+        self.assertLess(elapsed, 5)
+
+
+class UploadFilesTestCase(FtpServerTestCase):
+    def test_closed_session_is_not_returned_to_pool(self):
+        paths = [self.local_file(name, 3 * 1024 * 1024)
+                 for name in ('zero.bin', 'first.bin', 'second.bin')]
+        sessions = []
+
+        def make_ftp():
+            if len(sessions) == 1:
+                # reconnect after first.bin lost its session
+                sessions.append(None)
+                raise ftplib.error_perm('530 Login incorrect.')
+            sessions.append(self.make_ftp())
+            return sessions[-1]
+
+        sendfile = socket.socket.sendfile
+
+        def dropping_sendfile(sock, file, *args, **kwargs):
+            if os.path.basename(file.name) == 'first.bin':
+                sessions[0].sock.shutdown(socket.SHUT_RDWR)
+                raise BrokenPipeError
+            return sendfile(sock, file, *args, **kwargs)
+
+        with mock.patch.object(socket.socket, 'sendfile', dropping_sendfile), \
+                self.assertRaises(ftplib.error_perm):
+            sftp_writer.upload_files(make_ftp, paths, workers=1)
+
+        self.assertUploaded(paths[0])
+        self.assertUploaded(paths[2])
+
+    def test_pool_drops_closed_sessions(self):
+        pool = sftp_writer.SessionPool(self.make_ftp, 1)
+        ftp = self.make_ftp()
+        ftp.close()
+
+        pool.acquire()
+        pool.release(ftp)
+
+        self.assertIsNone(pool.acquire())
+
+    def test_pool_reconnects_idle_session_dropped_by_server(self):
+        path = self.local_file('data.bin', 1024)
+        pool = sftp_writer.SessionPool(self.make_ftp, 1)
+        self.addCleanup(pool.close)
+        ftp = pool.acquire() or self.make_ftp()
+        pool.release(ftp)
+        # idle timeout on the server side
+        ftp.voidcmd('QUIT')
+        self.assertEqual(ftp.sock.recv(1, socket.MSG_PEEK), b'')
+
+        pool.run(sftp_writer.file_upload(path))
+
+        self.assertUploaded(path)
+        reconnected = pool.acquire()
+        pool.release(reconnected)
+        self.assertIsNot(reconnected, ftp)
+
+    def test_large_file_falls_back_when_ranges_are_refused(self):
+        path = self.local_file('large.bin', 3 * 1024 * 1024)
+
+        with mock.patch.object(sftp_writer, 'PARALLEL_UPLOAD_THRESHOLD',
+                               1024 * 1024):
+            sftp_writer.upload_files(self.make_ftp, [path], workers=3)
+
+        self.assertUploaded(path)
+        self.assertEqual(os.listdir(self.remote_dir), ['large.bin'])
+
+
+class SparseRestHandler(FTPHandler):
+    """Accepts REST beyond the end of the file, like vsftpd."""
+
+    logins = []
+    stores = []
+
+    def on_login(self, username):
+        self.logins.append(self)
+
+    def ftp_STOR(self, file, mode='w'):
+        self.stores.append((self, os.path.basename(file)))
+        rest = self._restart_position
+        if rest and os.path.isfile(file) and os.path.getsize(file) < rest:
+            os.truncate(file, rest)
+        return super().ftp_STOR(file, mode)
+
+
+class UploadRangesTestCase(FtpServerTestCase):
+    handler = SparseRestHandler
+
+    def setUp(self):
+        super().setUp()
+        del SparseRestHandler.logins[:]
+        del SparseRestHandler.stores[:]
+        patcher = mock.patch.object(sftp_writer, 'PARALLEL_UPLOAD_THRESHOLD',
+                                    1024 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_large_file_is_split_into_ranges(self):
+        path = self.local_file('large.bin', 5 * 1024 * 1024 + 123)
+
+        sftp_writer.upload_files(self.make_ftp, [path], workers=3)
+
+        self.assertUploaded(path)
+        self.assertEqual(os.listdir(self.remote_dir), ['large.bin'])
+        range_sessions = {session for session, name in self.handler.stores
+                          if name == 'large.bin.part'}
+        self.assertGreater(len(range_sessions), 1)
+        # ranges share the pool instead of opening sessions of their own
+        self.assertLessEqual(len(self.handler.logins), 3)
+
+    def test_partial_copy_is_resumed_instead_of_split(self):
+        path = self.local_file('large.bin', 5 * 1024 * 1024)
+        with open(path, 'rb') as f, \
+                open(os.path.join(self.remote_dir, 'large.bin'), 'wb') as r:
+            r.write(f.read(2000000))
+
+        sftp_writer.upload_files(self.make_ftp, [path], workers=3)
+
+        self.assertUploaded(path)
+        self.assertEqual([name for session, name in self.handler.stores],
+                         ['large.bin'])
+
+
+class IgnoredRestHandler(FTPHandler):
+    """Accepts REST beyond the end of the file but stores from its start."""
+
+    def ftp_STOR(self, file, mode='w'):
+        self._restart_position = 0
+        return super().ftp_STOR(file, mode)
+
+
+class IgnoredRestTestCase(FtpServerTestCase):
+    handler = IgnoredRestHandler
+
+    def test_part_with_wrong_size_is_not_renamed(self):
+        path = self.local_file('large.bin', 5 * 1024 * 1024)
+
+        with mock.patch.object(sftp_writer, 'PARALLEL_UPLOAD_THRESHOLD',
+                               1024 * 1024):
+            sftp_writer.upload_files(self.make_ftp, [path], workers=3)
+
+        self.assertUploaded(path)
+        self.assertEqual(os.listdir(self.remote_dir), ['large.bin'])
+
+
+class NoRenameHandler(SparseRestHandler):
+    """Refuses to rename files."""
+
+    def ftp_RNFR(self, path):
+        self.respond('550 Renaming is not allowed.')
+
+
+class NoRenameTestCase(FtpServerTestCase):
+    handler = NoRenameHandler
+
+    def test_part_is_removed_when_rename_is_refused(self):
+        path = self.local_file('large.bin', 5 * 1024 * 1024)
+
+        with mock.patch.object(sftp_writer, 'PARALLEL_UPLOAD_THRESHOLD',
+                               1024 * 1024):
+            sftp_writer.upload_files(self.make_ftp, [path], workers=3)
+
+        self.assertUploaded(path)
+        self.assertEqual(os.listdir(self.remote_dir), ['large.bin'])
+
+
+class ModeZHandler(FTPHandler):
+    """Accepts MODE Z and stores the deflated stream as it arrives."""
+
+    def ftp_MODE(self, line):
+        if line.upper() == 'Z':
+            self.respond('200 Transfer mode set to: Z')
+        else:
+            super().ftp_MODE(line)
+
+
+class StorbinaryDeflateTestCase(FtpServerTestCase):
+    handler = ModeZHandler
+
+    def test_sends_deflated_data(self):
+        path = self.local_file('data.bin', 3 * 1024 * 1024)
+        ftp = self.make_ftp()
+        self.addCleanup(ftp.close)
+
+        with open(path, 'rb') as f:
+            sftp_writer.storbinary_deflate(ftp, 'STOR data.bin', f)
+
+        remote = os.path.join(self.remote_dir, 'data.bin')
+        with open(path, 'rb') as local, open(remote, 'rb') as uploaded:
+            self.assertEqual(local.read(), zlib.decompress(uploaded.read()))
+
+    def break_data_connection(self, ftp, on_send=None):
+        """Make the next data connection of ``ftp`` fail on the first send."""
+        transfercmd = ftp.transfercmd
+
+        def failing_transfercmd(cmd, rest=None):
+            conn = transfercmd(cmd, rest)
+            broken = mock.MagicMock()
+            broken.__enter__.return_value = broken
+            broken.__exit__.side_effect = lambda *args: conn.close()
+            broken.sendall.side_effect = on_send or BrokenPipeError
+            return broken
+
+        return mock.patch.object(ftp, 'transfercmd', failing_transfercmd)
+
+    def test_failed_transfer_keeps_session_in_sync(self):
+        path = self.local_file('data.bin', 1024)
+        ftp = self.make_ftp()
+        self.addCleanup(ftp.close)
+
+        with self.break_data_connection(ftp), open(path, 'rb') as f, \
+                self.assertRaises(BrokenPipeError):
+            sftp_writer.storbinary_deflate(ftp, 'STOR data.bin', f)
+
+        self.assertEqual(ftp.voidcmd('NOOP')[:3], '200')
+
+    def test_dead_session_raises_transfer_error(self):
+        path = self.local_file('data.bin', 1024)
+        ftp = self.make_ftp()
+        self.addCleanup(ftp.close)
+
+        def drop_session(data):
+            ftp.sock.shutdown(socket.SHUT_RDWR)
+            raise BrokenPipeError
+
+        with self.break_data_connection(ftp, drop_session), \
+                open(path, 'rb') as f, self.assertRaises(BrokenPipeError):
+            sftp_writer.storbinary_deflate(ftp, 'STOR data.bin', f)
+        self.assertFalse(sftp_writer.is_alive(ftp))